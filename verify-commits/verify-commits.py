@@ -4,62 +4,117 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 """Verify commits against a trusted keys list."""
 import argparse
+import collections
+import concurrent.futures
+import contextlib
 import hashlib
 import os
 import subprocess
 import sys
+import threading
 import time
 
 GIT = os.getenv("GIT", "git")
+# Blobs at least this large, but not larger than the max, are read whole and
+# hashed in parallel when computing a Tree-SHA512. The others are streamed.
+PARALLEL_HASH_MIN_SIZE = 1 << 20
+PARALLEL_HASH_MAX_SIZE = 32 << 20
+# Maximum amount of blob data held in memory waiting to be hashed in parallel
+PARALLEL_HASH_MAX_IN_FLIGHT = 128 << 20
+# Size of the buffers used for reading the blobs from git cat-file
+PIPE_BUFFER_SIZE = 1 << 20
 
-
-def git_head_hash():
-    return subprocess.check_output([GIT, "rev-parse", "HEAD"]).decode()[:-1]
+# SHA512 hex digest, as encoded in the Tree-SHA512, of the blobs we already
+# hashed by blob id. Blobs are immutable, so these hold across commits and
+# submodules.
+blob_hexdigests = {}
 
 
-def git_show_parents_hashes(commit):
-    return subprocess.check_output(
-        [
-            GIT,
-            "show",
-            "-s",
-            "--no-show-signature",
-            "--no-decorate",
-            "--no-abbrev-commit",
-            "--format=format:%P",
-            commit,
-        ]
-    )
-
-
-def git_show_parent_time(commit):
-    return subprocess.check_output(
-        [
-            GIT,
-            "show",
-            "-s",
-            "--no-show-signature",
-            "--no-decorate",
-            "--no-abbrev-commit",
-            "--format=format:%ct",
-            commit,
-        ]
+def git_head_hash():
+    return subprocess.check_output([GIT, "rev-parse", "HEAD"]).rstrip().decode("ascii")
+
+
+# The metadata of a commit we are interested in
+CommitInfo = collections.namedtuple(
+    "CommitInfo", ["parents", "time", "tree", "hash", "body"]
+)
+
+
+def git_cat_file_requests(p, requests):
+    """Write all the {requests} lines to the git cat-file --buffer process {p}
+    and close its stdin. Returns the writer thread."""
+
+    # With --buffer git only flushes its output once stdin is closed, so queue
+    # all the requests up front. This is done from another thread as git would
+    # otherwise block writing replies we don't read yet, and us on writing the
+    # requests it doesn't read anymore.
+    def write_requests():
+        try:
+            p.stdin.writelines(req + b"\n" for req in requests)
+            p.stdin.close()
+        except BrokenPipeError:
+            # git exited early, the reader will notice the truncated output
+            pass
+
+    # Don't let the writer keep us alive if we bail out before draining git
+    writer = threading.Thread(target=write_requests, daemon=True)
+    writer.start()
+    return writer
+
+
+def read_commit(stream, commit):
+    """Read the reply to a {commit} request from a git cat-file --batch output
+    {stream}, and parse the commit object."""
+    # read header: commit hash, "commit", size
+    reply = stream.readline().split()
+    if len(reply) != 3:
+        raise ValueError("Could not find commit {}".format(commit))
+    size = int(reply[2])
+    data = stream.read(size + 1)
+    if len(data) != size + 1:
+        raise IOError("Premature EOF reading git cat-file output")
+    # the headers are separated from the message by an empty line
+    headers, _, body = data[:-1].partition(b"\n\n")
+    parents = []
+    # the message is in UTF-8 unless stated otherwise
+    encoding = "utf8"
+    for line in headers.split(b"\n"):
+        key, _, value = line.partition(b" ")
+        if key == b"tree":
+            tree = value.decode("ascii")
+        elif key == b"parent":
+            parents.append(value.decode("ascii"))
+        elif key == b"committer":
+            # Name <email> timestamp timezone
+            commit_time = int(value.rsplit(b" ", 2)[1])
+        elif key == b"encoding":
+            encoding = value.decode("ascii", "replace")
+    # Don't choke on a wrongly encoded message, the Tree-SHA512 trailer we are
+    # looking for is ASCII anyways.
+    try:
+        message = body.decode(encoding, "replace")
+    except LookupError:
+        message = body.decode("utf8", "replace")
+    return CommitInfo(parents, commit_time, tree, reply[0].decode("ascii"), message)
+
+
+def git_show_all_batch(commits):
+    """Get the parents, commit time, tree, hash and message of all the
+    {commits} at once, through a single git cat-file --buffer. Returns the
+    CommitInfo by commit."""
+    p = subprocess.Popen(
+        [GIT, "cat-file", "--batch", "--buffer"],
+        stdout=subprocess.PIPE,
+        stdin=subprocess.PIPE,
     )
-
-
-def git_show_tree_hash(commit):
-    return subprocess.check_output(
-        [
-            GIT,
-            "show",
-            "-s",
-            "--no-show-signature",
-            "--no-decorate",
-            "--no-abbrev-commit",
-            "--format=format:%T",
-            commit,
-        ]
+    writer = git_cat_file_requests(
+        p, [commit.encode("utf8") + b"^{commit}" for commit in commits]
     )
+    infos = {commit: read_commit(p.stdout, commit) for commit in commits}
+    writer.join()
+    if p.wait():
+        raise IOError("Non-zero return value executing git cat-file")
+    return infos
 
 
 def git_show_commit_hash(commit):
@@ -91,28 +146,66 @@ def git_show_commit_subject(commit):
     )
 
 
-def git_checkout(branch):
-    return subprocess.call([GIT, "checkout", "--force", "--quiet", branch])
+def git_merge_tree(parent1, parent2):
+    """Get the tree resulting from merging {parent2} into {parent1}, without
+    touching the working tree nor the index. Returns None if git refused to
+    merge them at all (eg unrelated histories)."""
+    res = subprocess.run(
+        [GIT, "merge-tree", "--write-tree", "--no-messages", parent1, parent2],
+        stdout=subprocess.PIPE,
+    )
+    # 1 means the merge has conflicts, but git still writes the (conflicted) tree
+    if res.returncode not in (0, 1):
+        return None
+    return res.stdout.split(b"\n", 1)[0].decode("ascii")
 
 
-def git_verify_commit(datadir, commit):
+def git_verify_commit(datadir, commit, env=None):
     """Verify the {commit} using the gpg.sh file from our {datadir}, which checks
     the {commit} signature against the trusted keys present in this same
     {datadir}"""
     return subprocess.call(
         [GIT, "-c", "gpg.program={}/gpg.sh".format(datadir), "verify-commit", commit],
         stdout=subprocess.DEVNULL,
+        env=env,
     )
 
 
-def tree_sha512sum(commit="HEAD"):
+def git_verify_commits(datadir, commits):
+    """Run git_verify_commit() for each of the (commit, env) {commits} in
+    parallel. Returns the exit codes by commit."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = executor.map(
+            lambda commit_env: git_verify_commit(datadir, *commit_env), commits
+        )
+        return {commit: res for (commit, _), res in zip(commits, results)}
+
+
+def grow_pipe(fd, size):
+    """Try to grow the kernel buffer of the pipe {fd} to {size} bytes. This is
+    only supported on Linux, and may be capped by /proc/sys/fs/pipe-max-size."""
+    try:
+        import fcntl
+
+        fcntl.fcntl(fd, getattr(fcntl, "F_SETPIPE_SZ", 1031), size)
+    except (ImportError, OSError):
+        pass
+
+
+def sha512_hexdigest(data):
+    return hashlib.sha512(data).hexdigest().encode("utf-8")
+
+
+def tree_sha512sum(commit="HEAD", cwd="."):
+    """Compute the Tree-SHA512 of {commit} (any tree-ish) in the repository at
+    {cwd}."""
     overall = hashlib.sha512()
 
     # request metadata for entire tree, recursively
+    # (name, blob) of all the files
     files = []
-    blob_by_name = {}
     for line in subprocess.check_output(
-        [GIT, "ls-tree", "--full-tree", "-r", commit]
+        [GIT, "-C", cwd, "ls-tree", "--full-tree", "-r", commit]
     ).splitlines():
         name_sep = line.index(b"\t")
         # perms, 'blob' or 'commit', blobid
@@ -121,49 +214,111 @@ def tree_sha512sum(commit="HEAD"):
         name = line[name_sep + 1 :]
         # If we hit a submodule, get the SHA512 of its tree as well.
         if metadata[1] == b"commit":
-            curdir = os.path.abspath(os.getcwd())
-            os.chdir(name)
-            overall.update(bytes.fromhex(tree_sha512sum(metadata[2].decode())))
-            os.chdir(curdir)
+            subdir = os.path.join(cwd, os.fsdecode(name))
+            overall.update(
+                bytes.fromhex(tree_sha512sum(metadata[2].decode("ascii"), subdir))
+            )
             continue
         assert metadata[1] == b"blob", f"{metadata}"
-        files.append(name)
-        blob_by_name[name] = metadata[2]
+        files.append((name, metadata[2]))
 
+    # ls-tree already lists the files ordered by path, so this is a linear
+    # pass. It is still needed, as ls-tree quotes the unusual paths which may
+    # then sort differently.
     files.sort()
+    # only request the blobs we don't know the hash of yet, once
+    new_blobs = list(
+        dict.fromkeys(blob for _, blob in files if blob not in blob_hexdigests)
+    )
     # open connection to git-cat-file in batch mode to request data for all blobs
     # this is much faster than launching it per file
     p = subprocess.Popen(
-        [GIT, "cat-file", "--batch"], stdout=subprocess.PIPE, stdin=subprocess.PIPE
+        [GIT, "-C", cwd, "cat-file", "--batch", "--buffer"],
+        stdout=subprocess.PIPE,
+        stdin=subprocess.PIPE,
+        bufsize=PIPE_BUFFER_SIZE,
     )
-    for f in files:
-        blob = blob_by_name[f]
-        # request blob
-        p.stdin.write(blob + b"\n")
-        p.stdin.flush()
-        # read header: blob, "blob", size
-        reply = p.stdout.readline().split()
-        assert reply[0] == blob and reply[1] == b"blob"
-        size = int(reply[2])
-        # hash the blob data
-        intern = hashlib.sha512()
-        ptr = 0
-        while ptr < size:
-            bs = min(65536, size - ptr)
-            piece = p.stdout.read(bs)
-            if len(piece) == bs:
-                intern.update(piece)
-            else:
-                raise IOError("Premature EOF reading git cat-file output")
-            ptr += bs
-        dig = intern.hexdigest()
-        assert p.stdout.read(1) == b"\n"  # ignore LF that follows blob data
+    # let git write large blobs in as few chunks as we read them
+    grow_pipe(p.stdout.fileno(), PIPE_BUFFER_SIZE)
+
+    writer = git_cat_file_requests(p, new_blobs)
+
+    def update_overall(name, blob):
+        nonlocal in_flight_size
+        if blob not in blob_hexdigests:
+            future, size = in_flight.pop(blob)
+            blob_hexdigests[blob] = future.result()
+            in_flight_size -= size
         # update overall hash with file hash
-        overall.update(dig.encode("utf-8"))
-        overall.update("  ".encode("utf-8"))
-        overall.update(f)
-        overall.update("\n".encode("utf-8"))
-    p.stdin.close()
+        overall.update(blob_hexdigests[blob] + b"  " + name + b"\n")
+
+    # reuse a single buffer for reading the blobs' data
+    buf = memoryview(bytearray(131072))
+    readinto = p.stdout.readinto
+    # (name, blob) not yet accounted for, in files order
+    pending = collections.deque()
+    # the Future of the hex digest and the size of the blobs being hashed by a
+    # worker, and their total size
+    in_flight = {}
+    in_flight_size = 0
+    # hashing in parallel is only worth it with several CPUs
+    workers = os.cpu_count() or 1
+    if workers > 1:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    else:
+        pool = contextlib.nullcontext()
+    with pool as executor:
+        for f, blob in files:
+            if blob in blob_hexdigests or blob in in_flight:
+                pending.append((f, blob))
+                continue
+            # read header: blob, "blob", size
+            oid, kind, size = p.stdout.readline().rstrip(b"\n").split(b" ", 2)
+            assert oid == blob and kind == b"blob"
+            size = int(size)
+            # hash the blob data. Large blobs are hashed by a worker (hashlib
+            # releases the GIL) while we keep on reading the next ones.
+            # The blob data is followed by a LF, which is read along with it.
+            parallel = PARALLEL_HASH_MIN_SIZE <= size <= PARALLEL_HASH_MAX_SIZE
+            if executor is not None and parallel:
+                # wait for the workers if too much blob data is held in memory
+                while in_flight_size + size > PARALLEL_HASH_MAX_IN_FLIGHT:
+                    update_overall(*pending.popleft())
+                data = p.stdout.read(size + 1)
+                if len(data) != size + 1:
+                    raise IOError("Premature EOF reading git cat-file output")
+                assert data[size:] == b"\n"
+                future = executor.submit(sha512_hexdigest, memoryview(data)[:size])
+                in_flight[blob] = (future, size)
+                in_flight_size += size
+            else:
+                # this is the hot loop, avoid attribute lookups in there
+                intern = hashlib.sha512()
+                update = intern.update
+                ptr = 0
+                end = size + 1
+                while ptr < end:
+                    n = readinto(buf[: min(len(buf), end - ptr)])
+                    if n == 0:
+                        raise IOError("Premature EOF reading git cat-file output")
+                    ptr += n
+                    if ptr == end:
+                        # ignore LF that follows blob data
+                        n -= 1
+                        assert buf[n] == ord("\n")
+                    update(buf[:n])
+                blob_hexdigests[blob] = intern.hexdigest().encode("utf-8")
+            pending.append((f, blob))
+
+            # account for the file hashes available so far, in order
+            while pending:
+                blob = pending[0][1]
+                if blob in in_flight and not in_flight[blob][0].done():
+                    break
+                update_overall(*pending.popleft())
+        while pending:
+            update_overall(*pending.popleft())
+    writer.join()
     if p.wait():
         raise IOError("Non-zero return value executing git cat-file")
     return overall.hexdigest()
@@ -213,30 +368,83 @@ def main():
     sha_path = os.path.join(datadir, "trusted-sha512-root-commit")
     verified_sha512_root = open(sha_path, "r", encoding="utf8").read().splitlines()[0]
     revsig_path = os.path.join(datadir, "allow-revsig-commits")
-    revsig_allowed = open(revsig_path, "r", encoding="utf-8").read().splitlines()
+    # The allow lists are looked up for each commit, store them as sets
+    revsig_allowed = frozenset(
+        open(revsig_path, "r", encoding="utf-8").read().splitlines()
+    )
     unclean_path = os.path.join(datadir, "allow-unclean-merge-commits")
-    unclean_merge_allowed = (
+    unclean_merge_allowed = frozenset(
         open(unclean_path, "r", encoding="utf-8").read().splitlines()
     )
     incorrect_sha_path = os.path.join(datadir, "allow-incorrect-sha512-commits")
-    incorrect_sha512_allowed = (
+    incorrect_sha512_allowed = frozenset(
         open(incorrect_sha_path, "r", encoding="utf-8").read().splitlines()
     )
     trusted_keys_path = os.path.join(datadir, "trusted-keys")
 
-    # Set commit and branch and set variables
+    base_env = dict(
+        os.environ, REVAULT_VERIFY_COMMITS_TRUSTED_KEYS_PATH=trusted_keys_path
+    )
+
+    def verify_env(commit, allow_sha1):
+        """The environment gpg.sh is run with to verify {commit}"""
+        allow_revsig = commit in revsig_allowed
+        return dict(
+            base_env,
+            REVAULT_VERIFY_COMMITS_ALLOW_SHA1="1" if allow_sha1 else "0",
+            REVAULT_VERIFY_COMMITS_ALLOW_REVSIG="1" if allow_revsig else "0",
+        )
+
+    # Set commit and set variables
     current_commit = args.commit
     if " " in current_commit:
         print("Commit must not contain spaces", file=sys.stderr)
         sys.exit(1)
     verify_tree = args.verify_tree
-    no_sha1 = True
     prev_commit = ""
     initial_commit = current_commit
-    branch = git_show_commit_hash(initial_commit).decode("utf8").splitlines()[0]
+    # The last tree we computed the Tree-SHA512 of, and its Tree-SHA512
+    last_tree, last_tree_hash = None, None
+
+    # Get the whole chain of first parents down to the root of trust at once,
+    # along with the metadata of all its commits.
+    chain = (
+        subprocess.check_output(
+            [GIT, "rev-list", "--first-parent", current_commit, "^" + verified_root]
+        )
+        .decode("ascii")
+        .split()
+    )
+    commit_infos = git_show_all_batch(chain)
+    # rev-list stops at the root of trust or any of its ancestors, make sure we
+    # actually reached it
+    if chain:
+        reached_root = commit_infos[chain[-1]].parents[:1] == [verified_root]
+    else:
+        initial_info = git_show_all_batch([current_commit])[current_commit]
+        reached_root = initial_info.hash == verified_root
+    if not reached_root:
+        print(
+            "{} is not a first parent ancestor of {}".format(
+                verified_root, initial_commit
+            ),
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    # Verify the signatures of the commits we are going to walk through in
+    # parallel beforehand, as running gpg for each of them one after the other
+    # would dominate the walk otherwise.
+    to_verify = []
+    allow_sha1 = False
+    for commit in chain:
+        if commit == verified_sha512_root:
+            allow_sha1 = True
+        to_verify.append((commit, verify_env(commit, allow_sha1)))
+    verified = git_verify_commits(bindir, to_verify)
 
     # Iterate through commits
-    while True:
+    for current_commit in chain + [verified_root]:
         print(current_commit, verified_root)
         if current_commit == verified_root:
             print(
@@ -252,16 +460,9 @@ def main():
                     file=sys.stderr,
                 )
             verify_tree = False
-            no_sha1 = False
-
-        os.environ["REVAULT_VERIFY_COMMITS_ALLOW_SHA1"] = "0" if no_sha1 else "1"
-        os.environ["REVAULT_VERIFY_COMMITS_ALLOW_REVSIG"] = (
-            "1" if current_commit in revsig_allowed else "0"
-        )
-        os.environ["REVAULT_VERIFY_COMMITS_TRUSTED_KEYS_PATH"] = trusted_keys_path
 
         # Check that the commit (and parents) was signed with a trusted key
-        if git_verify_commit(bindir, current_commit):
+        if verified[current_commit]:
             if prev_commit != "":
                 print(
                     "No parent of {} was signed with a trusted key!".format(
@@ -270,13 +471,7 @@ def main():
                     file=sys.stderr,
                 )
                 print("Parents are:", file=sys.stderr)
-                parents = (
-                    git_show_parents_hashes(prev_commit)
-                    .decode("utf8")
-                    .splitlines()[0]
-                    .split(" ")
-                )
-                for parent in parents:
+                for parent in commit_infos[prev_commit].parents:
                     git_show_commit_hash(parent)
             else:
                 print(
@@ -285,14 +480,19 @@ def main():
                 )
             sys.exit(1)
 
+        commit_info = commit_infos[current_commit]
+
         # Check the Tree-SHA512
         if (
             verify_tree or prev_commit == ""
         ) and current_commit not in incorrect_sha512_allowed:
-            tree_hash = tree_sha512sum(current_commit)
-            if ("Tree-SHA512: {}".format(tree_hash)) not in subprocess.check_output(
-                [GIT, "show", "-s", "--format=format:%B", current_commit]
-            ).decode("utf8").splitlines():
+            # Consecutive commits may share the same tree (eg empty commits),
+            # don't hash it again.
+            if commit_info.tree != last_tree:
+                last_tree = commit_info.tree
+                last_tree_hash = tree_sha512sum(last_tree)
+            tree_hash = last_tree_hash
+            if "Tree-SHA512: {}".format(tree_hash) not in commit_info.body.splitlines():
                 print(
                     "Tree-SHA512 did not match for commit " + current_commit,
                     file=sys.stderr,
@@ -300,12 +500,7 @@ def main():
                 sys.exit(1)
 
         # Merge commits should only have two parents
-        parents = (
-            git_show_parents_hashes(current_commit)
-            .decode("utf8")
-            .splitlines()[0]
-            .split(" ")
-        )
+        parents = commit_info.parents
         if len(parents) > 2:
             print(
                 "Commit {} is an octopus merge".format(current_commit), file=sys.stderr
@@ -313,35 +508,23 @@ def main():
             sys.exit(1)
 
         # Check that the merge commit is clean
-        commit_time = int(
-            git_show_parent_time(current_commit).decode("utf8").splitlines()[0]
-        )
         check_merge = (
-            commit_time > time.time() - args.clean_merge * 24 * 60 * 60
+            commit_info.time > time.time() - args.clean_merge * 24 * 60 * 60
         )  # Only check commits in clean_merge days
         allow_unclean = current_commit in unclean_merge_allowed
         if len(parents) == 2 and check_merge and not allow_unclean:
-            current_tree = (
-                git_show_tree_hash(current_commit).decode("utf8").splitlines()[0]
-            )
-            git_checkout(parents[0])
-            subprocess.call(
-                [GIT, "merge", "--no-ff", "--quiet", "--no-gpg-sign", parents[1]],
-                stdout=subprocess.DEVNULL,
-            )
-            recreated_tree = git_show_tree_hash("HEAD").decode("utf8").splitlines()[0]
+            current_tree = commit_info.tree
+            recreated_tree = git_merge_tree(parents[0], parents[1])
             if current_tree != recreated_tree:
                 print(
                     "Merge commit {} is not clean".format(current_commit),
                     file=sys.stderr,
                 )
-                subprocess.call([GIT, "diff", current_commit])
-                git_checkout(branch)
+                if recreated_tree is not None:
+                    subprocess.call([GIT, "diff", current_commit, recreated_tree])
                 sys.exit(1)
-            git_checkout(branch)
 
         prev_commit = current_commit
-        current_commit = parents[0]
 
 
 if __name__ == "__main__":